@@ -1,6 +1,17 @@
 import os
+import re
+import sys
 import json
-from datetime import datetime
+import time
+import queue
+import atexit
+import logging
+import threading
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
 
 TIMEZONE = ZoneInfo("Asia/Taipei")
@@ -11,14 +22,31 @@ from linebot.v3.messaging import (
     MessagingApi, Configuration, ApiClient,
     ReplyMessageRequest, TextMessage
 )
-from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.webhooks import MessageEvent, TextMessageContent
 
-import gspread
-from google.oauth2.service_account import Credentials
-
 app = Flask(__name__)
 
+# ===== LOGGING =====
+# Request threads only enqueue records; the listener thread does the stdout writes
+logger = logging.getLogger("finbot")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_log_stream = logging.StreamHandler(sys.stdout)
+_log_stream.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s %(message)s"))
+_log_listener = None
+
+def _start_log_listener():
+    global _log_listener
+    log_queue = queue.Queue(-1)
+    logger.handlers = [QueueHandler(log_queue)]
+    _log_listener = QueueListener(log_queue, _log_stream)
+    _log_listener.start()
+
+_start_log_listener()
+# Forked workers (e.g. gunicorn --preload) don't inherit the listener thread, so each one starts its own
+os.register_at_fork(after_in_child=_start_log_listener)
+atexit.register(lambda: _log_listener.stop())
+
 # ===== ENV VARS =====
 CHANNEL_SECRET = os.environ.get("CHANNEL_SECRET")
 CHANNEL_ACCESS_TOKEN = os.environ.get("CHANNEL_ACCESS_TOKEN")
@@ -35,30 +63,220 @@ if not GOOGLE_CREDENTIALS_JSON:
 if missing:
     raise RuntimeError("Missing environment variables: " + ", ".join(missing))
 
-# Google credentials
-creds_info = json.loads(GOOGLE_CREDENTIALS_JSON)
-scopes = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
-creds = Credentials.from_service_account_info(creds_info, scopes=scopes)
-gc = gspread.authorize(creds)
-spreadsheet = gc.open(SHEET_NAME)
+# Parsed here so a malformed value stops the worker at boot instead of failing every message later
+try:
+    GOOGLE_CREDENTIALS = json.loads(GOOGLE_CREDENTIALS_JSON)
+except ValueError as e:
+    raise RuntimeError(f"GOOGLE_CREDENTIALS_JSON is not valid JSON: {e}") from None
+
+# ===== GOOGLE SHEETS =====
+WORKSHEET_TITLES = ("Transactions", "Balances", "Categories", "Transfers", "Reports")
+SCOPES = ("https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive")
+
+TOKEN_REFRESH_MARGIN = 300  # seconds before expiry to fetch a new access token
+
+def _keep_token_fresh(creds):
+    # Refresh ahead of expiry so no webhook waits on the OAuth token exchange
+    from google.auth.transport.requests import Request
+    while True:
+        # Opening the spreadsheet already fetched a token, so wait out the current one first
+        expires_in = 0
+        if creds.expiry:  # google-auth keeps expiry as naive UTC
+            expires_in = (creds.expiry - datetime.now(timezone.utc).replace(tzinfo=None)).total_seconds()
+        time.sleep(max(expires_in - TOKEN_REFRESH_MARGIN, 60))
+        try:
+            creds.refresh(Request())
+        except Exception as e:
+            logger.warning("Failed to refresh Google access token: %s", e)
+
+# gspread/google-auth are imported and authorized on first use, so worker boot and /health don't wait on Google
+# lru_cache doesn't serialize a first call that is still running, so the warm-up thread and
+# the first webhooks would each authorize and open the spreadsheet without this lock
+_worksheets_lock = threading.Lock()
+
+def get_worksheets():
+    with _worksheets_lock:
+        return _open_worksheets()
+
+@functools.lru_cache(maxsize=1)
+def _open_worksheets():
+    import gspread
+    from google.oauth2.service_account import Credentials
+    from google.auth.transport.requests import AuthorizedSession
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
 
-# Worksheets
-transactions_sheet = spreadsheet.worksheet("Transactions")
-balances_sheet = spreadsheet.worksheet("Balances")
-categories_sheet = spreadsheet.worksheet("Categories")
-transfers_sheet = spreadsheet.worksheet("Transfers")
-reports_sheet = spreadsheet.worksheet("Reports")
+    creds = Credentials.from_service_account_info(GOOGLE_CREDENTIALS, scopes=SCOPES)
+    # Keep TCP/TLS connections to the Sheets API alive across calls, and retry
+    # idempotent calls (reads, update_cell) on dropped connections, quota and 5xx errors
+    retries = Retry(total=3, backoff_factor=0.2, status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False)
+    sheets_session = AuthorizedSession(creds)
+    sheets_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retries))
+    gc = gspread.authorize(creds, session=sheets_session)
+    spreadsheet = gc.open(SHEET_NAME)
+
+    # One metadata call for every tab instead of one worksheet() lookup per tab
+    worksheets = {ws.title: ws for ws in spreadsheet.worksheets()}
+    missing_sheets = [title for title in WORKSHEET_TITLES if title not in worksheets]
+    if missing_sheets:
+        raise RuntimeError("Missing worksheets: " + ", ".join(missing_sheets))
+    # Only once init succeeded: lru_cache doesn't cache exceptions, so a failed call is retried
+    threading.Thread(target=_keep_token_fresh, args=(creds,), daemon=True).start()
+    return worksheets
+
+def worksheet(title):
+    return get_worksheets()[title]
 
 # LINE
 configuration = Configuration(access_token=CHANNEL_ACCESS_TOKEN)
 handler = WebhookHandler(CHANNEL_SECRET)
+# One client for the process so replies reuse its connection pool
+line_api_client = ApiClient(configuration)
+messaging_api = MessagingApi(line_api_client)
+atexit.register(line_api_client.close)
+
+# ===== READ CACHE =====
+# Worksheet values keyed by sheet title as (expiry, values); dropped whenever rows are appended
+_sheet_cache = {}
+
+# Columns each report actually uses, so reads skip any helper columns to the right
+SHEET_RANGES = {
+    "Balances": "A:D",    # Place | Initial | Balance | Net
+    "Categories": "A:D",  # Category | Income | Expense | Net
+    "Reports": "A:J",     # Month | Income | Expense | Net | 3x (Category, Amount)
+}
+
+# Categories amounts are only summed, so fetch them as numbers instead of "$1,200" strings
+SHEET_RENDER_OPTIONS = {
+    "Categories": "UNFORMATTED_VALUE",
+}
+
+# Seconds a read is reused; the TTL bounds staleness from manual edits and other workers
+SHEET_TTLS = {
+    "Balances": 30,
+    "Categories": 60,
+    "Reports": 30,
+}
+
+def _cached_entry(title):
+    try:
+        flush_pending()  # make queued rows visible to the formulas being read
+    except Exception as e:
+        # The rows stay queued for the background retry; a report without them beats no reply
+        logger.warning("Reading %s without queued rows, write failed: %s", title, e)
+    now = time.monotonic()
+    cached = _sheet_cache.get(title)
+    if cached and cached[0] > now:
+        return cached
+    values = worksheet(title).get_values(
+        SHEET_RANGES.get(title),
+        value_render_option=SHEET_RENDER_OPTIONS.get(title),
+    )
+    cached = _sheet_cache[title] = (now + SHEET_TTLS.get(title, 0), values)
+    return cached
+
+def _cached_values(title):
+    return _cached_entry(title)[1]
+
+# ===== WRITE BUFFER =====
+# Rows queued by recent messages, written with one append_rows call per sheet
+_pending_tx = []
+_pending_transfers = []
+_flush_lock = threading.Lock()
+
+# Webhook events run here so /callback can answer LINE without waiting on Google.
+# One worker keeps commands in arrival order (setbalance twice, or "e ..." then "balance")
+_executor = ThreadPoolExecutor(max_workers=1)
+
+def flush_pending():
+    with _flush_lock:
+        for title, pending in (("Transactions", _pending_tx), ("Transfers", _pending_transfers)):
+            if not pending:
+                continue
+            rows = pending[:]
+            del pending[:len(rows)]
+            try:
+                # table_range pins the append to the table starting at A1 instead of letting Sheets detect it
+                worksheet(title).append_rows(rows, value_input_option="USER_ENTERED", table_range="A1")
+            except Exception:
+                pending[:0] = rows  # keep them for the next flush
+                raise
+            _sheet_cache.clear()  # Balances, Categories and Reports are derived from these sheets
+
+FLUSH_DELAY = 2  # seconds to wait for more rows before writing
+FLUSH_BATCH_SIZE = 5  # queued rows that trigger a write without waiting
+FLUSH_ATTEMPTS = 3  # failed writes in a row before logging at error level
+FLUSH_MAX_BACKOFF = 300  # seconds between retries while Sheets keeps failing
+
+# Appends run on their own single thread so a Sheets outage can't take webhook workers
+_writer = ThreadPoolExecutor(max_workers=1)
+# The one armed flush; stays set until the write it triggers has finished, so there's never a second retrier
+_flush_timer = None
+_flush_started = False  # its timer has fired and the write is queued or running
+_flush_failures = 0
+_flush_timer_lock = threading.Lock()
+
+def _arm_flush(delay):
+    # Caller holds _flush_timer_lock
+    global _flush_timer, _flush_started
+    _flush_started = False
+    timer = _flush_timer = threading.Timer(delay, _start_flush)
+    timer.args = (timer,)
+    timer.daemon = True
+    timer.start()
+
+def _start_flush(timer):
+    global _flush_started
+    with _flush_timer_lock:
+        if timer is not _flush_timer:  # replaced by a sooner flush
+            return
+        _flush_started = True
+    _writer.submit(_flush_in_background)
+
+def _schedule_flush():
+    batch_full = len(_pending_tx) + len(_pending_transfers) >= FLUSH_BATCH_SIZE
+    with _flush_timer_lock:
+        if _flush_timer is None:
+            _arm_flush(0 if batch_full else FLUSH_DELAY)
+        elif batch_full and not _flush_started and not _flush_failures:
+            # Still waiting out FLUSH_DELAY; write now instead
+            _flush_timer.cancel()
+            _arm_flush(0)
+
+def _flush_in_background():
+    global _flush_timer, _flush_started, _flush_failures
+    try:
+        flush_pending()
+    except Exception as e:
+        with _flush_timer_lock:
+            _flush_failures += 1
+            delay = min(FLUSH_DELAY * 2 ** _flush_failures, FLUSH_MAX_BACKOFF)
+            # The user was already told "saved", so keep retrying with a growing delay
+            level = logging.ERROR if _flush_failures >= FLUSH_ATTEMPTS else logging.WARNING
+            logger.log(level, "Failed to write queued rows (attempt %d), retrying in %ds: %s", _flush_failures, delay, e)
+            _arm_flush(delay)
+        return
+    with _flush_timer_lock:
+        _flush_failures = 0
+        _flush_timer = None
+        _flush_started = False
+        if _pending_tx or _pending_transfers:  # queued while this write ran
+            _arm_flush(FLUSH_DELAY)
+
+@atexit.register
+def _flush_at_exit():
+    try:
+        flush_pending()
+    except Exception as e:
+        logger.error("Dropped queued rows at shutdown: %s", e)
 
 # ===== SHEET FUNCTIONS =====
 def add_transaction(type_, amount, category, place, note="", invoice_number=""):
-    date_value = datetime.now(TIMEZONE)
-    date_text = date_value.strftime("%m/%d/%Y %H:%M:%S")
-    transactions_sheet.append_row([date_text, type_, amount, category, place, note, invoice_number], value_input_option="USER_ENTERED")
-    print(f"[{datetime.now().isoformat()}] Appended transaction -> {date_text} | {type_} | {amount} | {category} | {place} | Invoice: {invoice_number if invoice_number else 'N/A'}")
+    now = datetime.now(TIMEZONE)
+    date_text = now.strftime("%m/%d/%Y %H:%M:%S")
+    _pending_tx.append([date_text, type_, amount, category, place, note, invoice_number])
+    _schedule_flush()
+    logger.info("Queued transaction -> %s | %s | %s | %s | %s | Invoice: %s", date_text, type_, amount, category, place, invoice_number or "N/A")
     
     response = f"✅ NT${amount:,} {type_} ({category}) {'to' if type_=='Income' else 'from'} {place} saved."
     if invoice_number:
@@ -66,39 +284,67 @@ def add_transaction(type_, amount, category, place, note="", invoice_number=""):
     return response
 
 def add_transfer(from_place, to_place, amount, note=""):
-    date_value = datetime.now(TIMEZONE)
-    date_text = date_value.strftime("%m/%d/%Y %H:%M:%S")
-    transfers_sheet.append_row([date_text, from_place, to_place, amount, note], value_input_option="USER_ENTERED")
-    print(f"[{datetime.now().isoformat()}] Appended transaction -> {date_text} | Transfer | {amount} |  | {from_place} | {to_place}")
+    now = datetime.now(TIMEZONE)
+    date_text = now.strftime("%m/%d/%Y %H:%M:%S")
+    _pending_transfers.append([date_text, from_place, to_place, amount, note])
+    _schedule_flush()
+    logger.info("Queued transfer -> %s | Transfer | %s |  | %s | %s", date_text, amount, from_place, to_place)
     return f"🔄 Transfer {amount} TWD from {from_place} to {to_place} saved."
 
+# Balances sheet row per lowercase place, so set_balance can write one cell without re-reading.
+# Only set_balance rebuilds it, under _balance_lock, and it expires with the snapshot it was built from
+_balance_index = (0, {})  # (expiry, rows)
+_balance_lock = threading.Lock()
+_RANGE_ROW_RE = re.compile(r"![A-Z]+(\d+)")
+
+def _index_balance_rows(expiry, values):
+    global _balance_index
+    rows = {}
+    for row_idx, row in enumerate(values[1:], start=2):  # skip header
+        if row and row[0]:
+            rows[row[0].lower()] = row_idx
+    _balance_index = (expiry, rows)
+
 def set_balance(place, amount):
-    values = balances_sheet.get_all_values()
-    places = [row[0].lower() for row in values[1:]]  # skip header
-    if place.lower() in places:
-        row_idx = places.index(place.lower()) + 2
-        balances_sheet.update_cell(row_idx, 2, amount)  # column B = Initial Balance
-    else:
-        balances_sheet.append_row([place.capitalize(), amount, "", ""])  # Place, Initial, Balance (formula), Net (formula)
+    with _balance_lock:
+        if _balance_index[0] <= time.monotonic():
+            _index_balance_rows(*_cached_entry("Balances"))
+        rows = _balance_index[1]
+        row_idx = rows.get(place.lower())
+        if row_idx:
+            worksheet("Balances").update_cell(row_idx, 2, amount)  # column B = Initial Balance
+        else:
+            result = worksheet("Balances").append_row([place.capitalize(), amount, "", ""])  # Place, Initial, Balance (formula), Net (formula)
+            # Take the row Sheets actually wrote, other workers or manual edits may have added rows since our read
+            rows[place.lower()] = int(_RANGE_ROW_RE.search(result["updates"]["updatedRange"]).group(1))
+        _sheet_cache.pop("Balances", None)
     return f"✅ Initial balance for {place.capitalize()} set: NT${amount:,}"
 
 def get_balance_report():
-    values = balances_sheet.get_all_values()
+    values = _cached_values("Balances")
     if len(values) <= 1:
         return "📊 No balances found."
     
     rows = values[1:]
-    report = "📊 Current Balances:\n"
+    report = ["📊 Current Balances:\n"]
     for row in rows:
         if len(row) < 4:
             continue
         place, initial, balance, net = row[0], row[1], row[2], row[3]
-        report += f"• {place}: NT${net}\n"
-        report += f"  (Initial: {initial}, Balance: {balance})\n"
-    return report
+        report.append(f"• {place}: NT${net}\n")
+        report.append(f"  (Initial: {initial}, Balance: {balance})\n")
+    return "".join(report)
+
+# Currency formatting a formatted cell may carry, e.g. "$1,200"
+_AMOUNT_STRIP = str.maketrans("", "", "$,")
+
+def _to_float(value):
+    if isinstance(value, (int, float)):
+        return value
+    return float(value.translate(_AMOUNT_STRIP)) if value else 0
 
 def get_categories_report():
-    values = categories_sheet.get_all_values()
+    values = _cached_values("Categories")
     if len(values) <= 1:
         return "📊 No categories found."
     
@@ -107,47 +353,38 @@ def get_categories_report():
     
     total_income = 0
     total_expense = 0
+    income_lines = []
+    expense_lines = []
     
-    report = "📊 Categories Summary:\n\n"
-    report += "📈 Income:\n"
     for row in rows:
         if len(row) < 4:
             continue
         category, income, expense, net = row[0], row[1], row[2], row[3]
         try:
-            income_val = float(str(income).replace('$', '').replace(',', '')) if income else 0
-            expense_val = float(str(expense).replace('$', '').replace(',', '')) if expense else 0
-            
-            if income_val > 0:
-                report += f"  • {category}: NT${income_val:,.0f}\n"
-                total_income += income_val
-        except:
-            continue
-    
-    report += f"\n💰 Total Income: NT${total_income:,.0f}\n\n"
-    report += "📉 Expenses:\n"
-    
-    for row in rows:
-        if len(row) < 4:
-            continue
-        category, income, expense, net = row[0], row[1], row[2], row[3]
-        try:
-            income_val = float(str(income).replace('$', '').replace(',', '')) if income else 0
-            expense_val = float(str(expense).replace('$', '').replace(',', '')) if expense else 0
-            
-            if expense_val > 0:
-                report += f"  • {category}: NT${expense_val:,.0f}\n"
-                total_expense += expense_val
+            income_val = _to_float(income)
+            expense_val = _to_float(expense)
         except:
             continue
+        
+        if income_val > 0:
+            income_lines.append(f"  • {category}: NT${income_val:,.0f}\n")
+            total_income += income_val
+        if expense_val > 0:
+            expense_lines.append(f"  • {category}: NT${expense_val:,.0f}\n")
+            total_expense += expense_val
     
-    report += f"\n💸 Total Expense: NT${total_expense:,.0f}\n"
-    report += f"💵 Net: NT${(total_income - total_expense):,.0f}"
+    report = ["📊 Categories Summary:\n\n", "📈 Income:\n"]
+    report.extend(income_lines)
+    report.append(f"\n💰 Total Income: NT${total_income:,.0f}\n\n")
+    report.append("📉 Expenses:\n")
+    report.extend(expense_lines)
+    report.append(f"\n💸 Total Expense: NT${total_expense:,.0f}\n")
+    report.append(f"💵 Net: NT${(total_income - total_expense):,.0f}")
     
-    return report
+    return "".join(report)
 
 def get_report(year, month):
-    values = reports_sheet.get_all_values()
+    values = _cached_values("Reports")
     if len(values) <= 1:
         return f"📅 No report found for {year}-{month:02d}"
     
@@ -160,18 +397,20 @@ def get_report(year, month):
         if len(row) < 1:
             continue
         if row[0] == target_month:
-            report = f"📅 Report for {target_month}\n\n"
-            report += f"📈 Income: NT${row[1]}\n"
-            report += f"📉 Expense: NT${row[2]}\n"
-            report += f"💵 Net: NT${row[3]}\n"
+            report = [
+                f"📅 Report for {target_month}\n\n",
+                f"📈 Income: NT${row[1]}\n",
+                f"📉 Expense: NT${row[2]}\n",
+                f"💵 Net: NT${row[3]}\n",
+            ]
             
             if len(row) > 4 and row[4]:
-                report += f"\n🔥 Top Expenses:\n"
+                report.append("\n🔥 Top Expenses:\n")
                 for i in range(4, min(len(row), 10), 2):
                     if i+1 < len(row) and row[i]:
-                        report += f"  • {row[i]}: NT${row[i+1]}\n"
+                        report.append(f"  • {row[i]}: NT${row[i+1]}\n")
             
-            return report
+            return "".join(report)
     
     return f"📅 No report found for {target_month}"
 
@@ -180,119 +419,216 @@ def get_report(year, month):
 def callback():
     signature = request.headers.get("X-Line-Signature", "")
     body = request.get_data(as_text=True)
-    try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
+    if not handler.parser.signature_validator.validate(body, signature):
         abort(400)
+    # Acknowledge LINE right away; Sheets reads/writes and the reply happen on the executor
+    _executor.submit(_process_webhook, body, signature)
     return "OK"
 
+def _process_webhook(body, signature):
+    try:
+        handler.handle(body, signature)
+    except Exception as e:
+        logger.exception("Failed to handle webhook: %s", e)
+
+# Message ids seen recently, so LINE redeliveries don't record the same transaction twice
+SEEN_MESSAGES_MAX = 4096
+_seen_order = deque()
+_seen_ids = set()
+_seen_lock = threading.Lock()  # stays correct if _executor is ever given more workers
+
+def _already_seen(message_id):
+    with _seen_lock:
+        if message_id in _seen_ids:
+            return True
+        _seen_order.append(message_id)
+        _seen_ids.add(message_id)
+        if len(_seen_order) > SEEN_MESSAGES_MAX:
+            _seen_ids.discard(_seen_order.popleft())
+        return False
+
+# ===== COMMANDS =====
+HELP_TEXT = (
+    "🤖 Finance Bot Commands:\n\n"
+    "📌 Transactions:\n"
+    "  i <amount> <category> <place> [note]\n"
+    "  e <amount> <category> <place> [note] [inv:NUMBER]\n\n"
+    "📌 Transfers:\n"
+    "  transfer <from> <to> <amount> [note]\n\n"
+    "📌 Balances:\n"
+    "  balance\n"
+    "  setbalance <place> <amount>\n\n"
+    "📌 Reports:\n"
+    "  categories\n"
+    "  report [YYYY-MM]\n\n"
+    "📌 Other:\n"
+    "  help"
+)
+
+UNKNOWN_COMMAND_TEXT = "❌ Unknown command. Type 'help' to see available commands."
+
+def _parse_amount(text):
+    # Whole NT$ amounts, optionally negative; None when the token isn't a number
+    return int(text) if (text[1:] if text[:1] == "-" else text).isdecimal() else None
+
+INCOME_COMMANDS = frozenset({"i", "income"})
+
+# Invoice token in a transaction note, e.g. "inv:AB12345678"
+_INVOICE_RE = re.compile(r"inv:(.*)", re.IGNORECASE)
+
+# ---- Transactions ----
+def _cmd_transaction(event, parts):
+    type_ = "Income" if parts[0] in INCOME_COMMANDS else "Expense"
+    amount = _parse_amount(parts[1]) if len(parts) > 1 else None
+    if amount is None:
+        return reply_text(event.reply_token, "❌ Format: e/i amount category place [note] [inv:NUMBER]")
+    
+    category = (parts[2] if len(parts) > 2 else "Other").capitalize()
+    place = (parts[3] if len(parts) > 3 else "Unknown").capitalize()
+    
+    # Parse note and invoice number
+    note_parts = []
+    invoice_number = ""
+    
+    for part in parts[4:]:
+        invoice_match = _INVOICE_RE.match(part)
+        if invoice_match:
+            invoice_number = invoice_match.group(1).upper()  # Extract invoice number after "inv:"
+        else:
+            note_parts.append(part)
+    
+    note = " ".join(note_parts)
+    
+    # Only add invoice for expenses
+    if type_ == "Expense":
+        return reply_text(event.reply_token, add_transaction(type_, amount, category, place, note, invoice_number))
+    else:
+        return reply_text(event.reply_token, add_transaction(type_, amount, category, place, note))
+
+# ---- Transfer ----
+def _cmd_transfer(event, parts):
+    if len(parts) < 4:
+        return _cmd_unknown(event, parts)
+    from_place, to_place = parts[1].capitalize(), parts[2].capitalize()
+    amount = _parse_amount(parts[3])
+    if amount is None:
+        return reply_text(event.reply_token, "❌ Format: transfer <from> <to> <amount> [note]")
+    note = " ".join(parts[4:]) if len(parts) > 4 else ""
+    return reply_text(event.reply_token, add_transfer(from_place, to_place, amount, note))
+
+# ---- Balance ----
+def _cmd_balance(event, parts):
+    return reply_text(event.reply_token, get_balance_report())
+
+def _cmd_setbalance(event, parts):
+    if len(parts) != 3:
+        return _cmd_unknown(event, parts)
+    place = parts[1].capitalize()
+    amount = _parse_amount(parts[2])
+    if amount is None:
+        return reply_text(event.reply_token, "❌ Format: setbalance <place> <amount>")
+    return reply_text(event.reply_token, set_balance(place, amount))
+
+# ---- Categories ----
+def _cmd_categories(event, parts):
+    return reply_text(event.reply_token, get_categories_report())
+
+# ---- Report ----
+def _cmd_report(event, parts):
+    today = datetime.now(TIMEZONE)
+    if len(parts) == 2 and "-" in parts[1]:
+        try:
+            year, month = map(int, parts[1].split("-"))
+        except:
+            year, month = today.year, today.month
+    else:
+        year, month = today.year, today.month
+    return reply_text(event.reply_token, get_report(year, month))
+
+# ---- Help ----
+def _cmd_help(event, parts):
+    return reply_text(event.reply_token, HELP_TEXT)
+
+# ---- Default ----
+def _cmd_unknown(event, parts):
+    return reply_text(event.reply_token, UNKNOWN_COMMAND_TEXT)
+
+COMMANDS = {
+    "i": _cmd_transaction,
+    "income": _cmd_transaction,
+    "e": _cmd_transaction,
+    "expense": _cmd_transaction,
+    "transfer": _cmd_transfer,
+    "balance": _cmd_balance,
+    "setbalance": _cmd_setbalance,
+    "categories": _cmd_categories,
+    "report": _cmd_report,
+    "help": _cmd_help,
+}
+
 @handler.add(MessageEvent, message=TextMessageContent)
 def handle_message(event: MessageEvent):
+    if _already_seen(event.message.id):
+        logger.info("Skipped redelivered message %s", event.message.id)
+        return
+
     text = (event.message.text or "").strip()
     parts = text.split()
     if not parts:
         return
 
-    cmd = parts[0].lower()
-
-    # ---- Transactions ----
-    if cmd in ("i", "income", "e", "expense"):
-        type_ = "Income" if cmd in ("i", "income") else "Expense"
-        try:
-            amount = int(parts[1])
-        except:
-            return reply_text(event.reply_token, "❌ Format: e/i amount category place [note] [inv:NUMBER]")
-        
-        category = (parts[2] if len(parts) > 2 else "Other").capitalize()
-        place = (parts[3] if len(parts) > 3 else "Unknown").capitalize()
-        
-        # Parse note and invoice number
-        note_parts = []
-        invoice_number = ""
-        
-        for part in parts[4:]:
-            if part.lower().startswith("inv:"):
-                invoice_number = part[4:].upper()  # Extract invoice number after "inv:"
-            else:
-                note_parts.append(part)
-        
-        note = " ".join(note_parts)
-        
-        # Only add invoice for expenses
-        if type_ == "Expense":
-            return reply_text(event.reply_token, add_transaction(type_, amount, category, place, note, invoice_number))
-        else:
-            return reply_text(event.reply_token, add_transaction(type_, amount, category, place, note))
-
-    # ---- Transfer ----
-    elif cmd == "transfer" and len(parts) >= 4:
-        from_place, to_place = parts[1].capitalize(), parts[2].capitalize()
-        amount = int(parts[3])
-        note = " ".join(parts[4:]) if len(parts) > 4 else ""
-        return reply_text(event.reply_token, add_transfer(from_place, to_place, amount, note))
-
-    # ---- Balance ----
-    elif cmd == "balance":
-        return reply_text(event.reply_token, get_balance_report())
-    elif cmd == "setbalance" and len(parts) == 3:
-        place = parts[1].capitalize()
-        amount = int(parts[2])
-        return reply_text(event.reply_token, set_balance(place, amount))
-    
-    # ---- Categories ----
-    elif cmd == "categories":
-        return reply_text(event.reply_token, get_categories_report())
-
-    # ---- Report ----
-    elif cmd == "report":
-        today = datetime.now(TIMEZONE)
-        if len(parts) == 2 and "-" in parts[1]:
-            try:
-                year, month = map(int, parts[1].split("-"))
-            except:
-                year, month = today.year, today.month
-        else:
-            year, month = today.year, today.month
-        return reply_text(event.reply_token, get_report(year, month))
-
-    # ---- Help ----
-    elif cmd == "help":
-        help_text = (
-            "🤖 Finance Bot Commands:\n\n"
-            "📌 Transactions:\n"
-            "  i <amount> <category> <place> [note]\n"
-            "  e <amount> <category> <place> [note] [inv:NUMBER]\n\n"
-            "📌 Transfers:\n"
-            "  transfer <from> <to> <amount> [note]\n\n"
-            "📌 Balances:\n"
-            "  balance\n"
-            "  setbalance <place> <amount>\n\n"
-            "📌 Reports:\n"
-            "  categories\n"
-            "  report [YYYY-MM]\n\n"
-            "📌 Other:\n"
-            "  help"
-        )
-        return reply_text(event.reply_token, help_text)
-
-    # ---- Default ----
-    reply = "❌ Unknown command. Type 'help' to see available commands."
-    return reply_text(event.reply_token, reply)
+    # Handlers get the command word already casefolded in parts[0]
+    cmd = parts[0] = parts[0].casefold()
+    return COMMANDS.get(cmd, _cmd_unknown)(event, parts)
 
 # ===== REPLY HELPERS =====
 def reply_text(reply_token: str, message: str):
-    with ApiClient(configuration) as api_client:
-        api = MessagingApi(api_client)
-        api.reply_message(
-            ReplyMessageRequest(
-                replyToken=reply_token,
-                messages=[TextMessage(text=message)]
-            )
+    messaging_api.reply_message(
+        ReplyMessageRequest(
+            replyToken=reply_token,
+            messages=[TextMessage(text=message)]
         )
+    )
 
 @app.get("/health")
 def health():
     return "OK"
 
+# Answer liveness probes before Flask builds a request context and routes the URL
+_flask_wsgi_app = app.wsgi_app
+
+def _health_fast_path(environ, start_response):
+    if environ.get("PATH_INFO") == "/health" and environ.get("REQUEST_METHOD") == "GET":
+        start_response("200 OK", [("Content-Type", "text/plain; charset=utf-8"), ("Content-Length", "2")])
+        return [b"OK"]
+    return _flask_wsgi_app(environ, start_response)
+
+app.wsgi_app = _health_fast_path
+
+# ===== WARM-UP =====
+# Authorize and prime the read cache in the background so the first message doesn't pay for it
+def _warm_up():
+    try:
+        for title in SHEET_RANGES:
+            _cached_values(title)
+    except Exception as e:
+        logger.warning("Sheets warm-up failed: %s", e)
+
+def _start_warm_up():
+    threading.Thread(target=_warm_up, daemon=True).start()
+
+def _reset_after_fork():
+    # A forked worker (e.g. gunicorn --preload) has none of the parent's threads; drop the parent's
+    # Sheets connection and any lock its warm-up held, then warm up this process on its own
+    global _worksheets_lock, _flush_lock
+    _worksheets_lock = threading.Lock()
+    _flush_lock = threading.Lock()
+    _open_worksheets.cache_clear()
+    _sheet_cache.clear()
+    _start_warm_up()
+
+_start_warm_up()
+os.register_at_fork(after_in_child=_reset_after_fork)
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)